@@ -0,0 +1,294 @@
+"""
+MedAssist AI Pro - Offline Batch Intake
+Digitise scanned ID and medical aid cards in bulk via the Gemini Batch API
+
+Usage:
+    # 1. Walk a directory of scans and write one batch request per card
+    python batch_intake.py prepare scans/ --output batch_requests.jsonl
+
+    # 2. Submit batch_requests.jsonl as a Gemini batch job, download the
+    #    results file, then validate and load the extracted patients into
+    #    the patient database (DATABASE_URL / POSTGRES_URL, else SQLite)
+    python batch_intake.py ingest batch_results.jsonl
+
+Cards are grouped per patient either by sub-directory (scans/<patient>/id.jpg,
+scans/<patient>/medical_aid.jpg) or by file name prefix (scans/<patient>_id.jpg,
+scans/<patient>_medical_aid.jpg).
+"""
+
+import argparse
+import base64
+import io
+import json
+import logging
+import os
+import re
+import sys
+from datetime import datetime
+
+from pydantic import ValidationError
+
+# simple_app configures a Streamlit page on import; outside `streamlit run`
+# those calls are no-ops, so keep their bare-mode warnings quiet
+logging.disable(logging.WARNING)
+
+from simple_app import (  # noqa: E402
+    DATABASE_URL,
+    ID_CARD_ADAPTER,
+    ID_CARD_PROMPT,
+    ID_CARD_SCHEMA,
+    MEDICAL_AID_ADAPTER,
+    MEDICAL_AID_PROMPT,
+    MEDICAL_AID_SCHEMA,
+    MRNAllocator,
+    PatientRepository,
+    build_card_image_part,
+    clean_json_response,
+)
+
+logging.disable(logging.NOTSET)
+
+CARD_EXTENSIONS = {".jpg", ".jpeg", ".png", ".pdf"}
+
+# Per card type: prompt, response schema and validator
+CARD_TYPES = {
+    "id_card": (ID_CARD_PROMPT, ID_CARD_SCHEMA, ID_CARD_ADAPTER),
+    "medical_aid": (MEDICAL_AID_PROMPT, MEDICAL_AID_SCHEMA, MEDICAL_AID_ADAPTER),
+}
+
+_MEDICAL_AID_NAME = re.compile(r"medical|aid|insurance|scheme", re.IGNORECASE)
+_ID_CARD_NAME = re.compile(r"(?:^|[_\-\s.])(?:id|identity|id_card|idcard)(?:$|[_\-\s.])", re.IGNORECASE)
+_CARD_NAME_TOKENS = re.compile(r"[_\-\s.]*(?:medical[_\-\s]?aid|medical|insurance|scheme|id[_\-\s]?card|identity|aid|id)[_\-\s.]*$", re.IGNORECASE)
+# Recovers the request key from a results line that is not valid JSON
+_RESULT_KEY = re.compile(r'"key"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+
+def classify_card(filename):
+    """Return "id_card", "medical_aid" or None from a scan's file name"""
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    if _MEDICAL_AID_NAME.search(stem):
+        return "medical_aid"
+    if _ID_CARD_NAME.search(stem) or stem.lower() in ("id", "idcard", "identity"):
+        return "id_card"
+    return None
+
+
+def patient_key_for(root, path):
+    """Group cards per patient: by sub-directory, else by file name prefix"""
+    relative_dir = os.path.relpath(os.path.dirname(path), root)
+    if relative_dir != ".":
+        return relative_dir.replace(os.sep, "/")
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return _CARD_NAME_TOKENS.sub("", stem) or stem
+
+
+def iter_card_files(root):
+    """Yield (patient_key, card_type, path) for every recognised scan under root"""
+    for directory, subdirectories, filenames in os.walk(root):
+        subdirectories.sort()
+        for filename in sorted(filenames):
+            if os.path.splitext(filename)[1].lower() not in CARD_EXTENSIONS:
+                continue
+            card_type = classify_card(filename)
+            if card_type is None:
+                print(f"skipping {os.path.join(directory, filename)}: not recognisable as an ID or medical aid card", file=sys.stderr)
+                continue
+            path = os.path.join(directory, filename)
+            yield patient_key_for(root, path), card_type, path
+
+
+def build_batch_request(key, card_type, path):
+    """Build one Gemini batch request line for a card scan.
+
+    The scan goes through the same preparation as interactive intake
+    (EXIF rotation, card crop, downscale, embedded PDF scan extraction) and is
+    sent inline with the card's prompt and response schema.
+    """
+    prompt, schema, _ = CARD_TYPES[card_type]
+    with open(path, "rb") as f:
+        upload = io.BytesIO(f.read())
+    upload.type = "application/pdf" if path.lower().endswith(".pdf") else ""
+
+    image_part, _ = build_card_image_part(upload)
+    inline_data = image_part.inline_data
+    return {
+        "key": key,
+        "request": {
+            "contents": [{
+                "role": "user",
+                "parts": [
+                    {"text": prompt},
+                    {"inlineData": {
+                        "mimeType": inline_data.mime_type,
+                        "data": base64.b64encode(inline_data.data).decode("ascii"),
+                    }},
+                ],
+            }],
+            "generationConfig": {
+                "responseMimeType": "application/json",
+                "responseSchema": schema,
+            },
+        },
+    }
+
+
+def prepare(args):
+    """Write batch requests for every card under args.cards_dir"""
+    seen_keys = set()
+    count = 0
+    with open(args.output, "w", encoding="utf-8") as out:
+        for patient_key, card_type, path in iter_card_files(args.cards_dir):
+            key = f"{patient_key}::{card_type}"
+            if key in seen_keys:
+                print(f"skipping {path}: patient '{patient_key}' already has a {card_type}", file=sys.stderr)
+                continue
+            seen_keys.add(key)
+            try:
+                request = build_batch_request(key, card_type, path)
+            except Exception as e:
+                print(f"skipping {path}: {e}", file=sys.stderr)
+                continue
+            out.write(json.dumps(request) + "\n")
+            count += 1
+    print(f"Wrote {count} batch requests to {args.output}")
+
+
+def response_text(result):
+    """Concatenate the text parts of a batch result's first candidate"""
+    candidates = (result.get("response") or {}).get("candidates") or []
+    if not candidates:
+        return ""
+    parts = (candidates[0].get("content") or {}).get("parts") or []
+    return "".join(part.get("text", "") for part in parts)
+
+
+def validate_card_result(card_type, text):
+    """Validate a batch response against IDCardData / MedicalAidData.
+
+    Schema-constrained output normally validates directly; otherwise the
+    JSON object is salvaged from the text before validation. Returns the
+    validated dict, or None.
+    """
+    adapter = CARD_TYPES[card_type][2]
+    try:
+        return adapter.validate_json(text).model_dump()
+    except ValidationError:
+        pass
+    salvaged = clean_json_response(text)
+    if salvaged is None:
+        return None
+    try:
+        return adapter.validate_python(salvaged).model_dump()
+    except ValidationError:
+        return None
+
+
+def card_is_readable(card_type, data):
+    """Same readability check as the interactive extractors"""
+    if card_type == "id_card":
+        return data["name"] != "Not readable" or data["id_number"] != "Not readable"
+    return data["scheme"] != "Not readable" or data["member_number"] != "Not readable"
+
+
+def patient_record(patient_key, cards, errors):
+    """Map validated card data onto the intake patient_data fields"""
+    id_card = cards.get("id_card") or {}
+    medical_aid = cards.get("medical_aid") or {}
+    return {
+        "patient_key": patient_key,
+        "name": id_card.get("name"),
+        "id_number": id_card.get("id_number"),
+        "dob": id_card.get("dob"),
+        "gender": id_card.get("gender"),
+        "nationality": id_card.get("nationality"),
+        "insurance_provider": medical_aid.get("scheme"),
+        "insurance_id": medical_aid.get("member_number"),
+        "insurance_plan": medical_aid.get("plan"),
+        "id_card": cards.get("id_card"),
+        "medical_aid": cards.get("medical_aid"),
+        "needs_review": bool(errors) or len(cards) < 2,
+        "errors": errors,
+        "ingested_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+def parse_result_line(line):
+    """Parse one results line; a malformed line yields only its error and key (if recoverable)"""
+    try:
+        return json.loads(line)
+    except json.JSONDecodeError as e:
+        match = _RESULT_KEY.search(line)
+        return {"key": json.loads(f'"{match.group(1)}"') if match else "",
+                "error": {"message": f"malformed result line ({e.msg})"}}
+
+
+def ingest(args):
+    """Validate batch results and save one record per patient to the database.
+
+    Re-running on the same results updates the same patients: each record
+    is stored under its patient key, and only patients not ingested before
+    are issued a new MRN.
+    """
+    cards_by_patient = {}
+    errors_by_patient = {}
+    with open(args.results, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            result = parse_result_line(line)
+            patient_key, _, card_type = result.get("key", "").rpartition("::")
+            if card_type not in CARD_TYPES:
+                reason = result["error"]["message"] if result.get("error") else f"unknown key {result.get('key')!r}"
+                print(f"line {line_number}: {reason}", file=sys.stderr)
+                continue
+
+            cards_by_patient.setdefault(patient_key, {})
+            errors = errors_by_patient.setdefault(patient_key, [])
+            if result.get("error"):
+                errors.append(f"{card_type}: {result['error'].get('message', result['error'])}")
+                continue
+
+            data = validate_card_result(card_type, response_text(result))
+            if data is None:
+                errors.append(f"{card_type}: response did not match the schema")
+            elif not card_is_readable(card_type, data):
+                errors.append(f"{card_type}: card not readable")
+            else:
+                cards_by_patient[patient_key][card_type] = data
+
+    records = [
+        patient_record(patient_key, cards_by_patient[patient_key], errors_by_patient[patient_key])
+        for patient_key in sorted(cards_by_patient)
+    ]
+    repository = PatientRepository(args.database_url)
+    ingested = repository.stored_batch_keys(cards_by_patient)
+    allocator = MRNAllocator(repository, block_size=max(1, len(records) - len(ingested)))
+    for record in records:
+        if record["patient_key"] not in ingested:
+            record["mrn"] = allocator.allocate()
+    # One transaction for the whole batch
+    repository.save_patients(records)
+    review = sum(record["needs_review"] for record in records)
+    print(f"Ingested {len(records)} patients ({review} flagged for review)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline batch intake for scanned ID and medical aid cards")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+
+    prepare_parser = subcommands.add_parser("prepare", help="Write Gemini batch requests for a directory of scans")
+    prepare_parser.add_argument("cards_dir", help="Directory of scanned ID and medical aid cards")
+    prepare_parser.add_argument("--output", default="batch_requests.jsonl", help="Batch request JSONL file to write")
+    prepare_parser.set_defaults(handler=prepare)
+
+    ingest_parser = subcommands.add_parser("ingest", help="Validate batch results and load them into the patient database")
+    ingest_parser.add_argument("results", help="Batch results JSONL file downloaded from Gemini")
+    ingest_parser.add_argument("--database-url", default=DATABASE_URL, help="SQLAlchemy database URL (default: DATABASE_URL)")
+    ingest_parser.set_defaults(handler=ingest)
+
+    args = parser.parse_args(argv)
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Benchmark: script work per widget interaction, full rerun vs fragment rerun
+
+Before fragments, any widget change re-ran the whole script: main(), the
+sidebar, CSS injection and the full stage function. With st.fragment only
+the section that owns the widget runs again. Each section's fragment is
+made to rerun itself N times through Streamlit's own st.rerun(), once with
+scope="app" and once with scope="fragment", inside the AppTest harness.
+The cost of one rerun is (time with N reruns - time with none) / N.
+
+Requesting a fragment-scoped rerun needs Streamlit internals (RerunData,
+ThreadState), so the benchmark is pinned to the Streamlit release it was
+written against and refuses to run on any other. Run from the repo root:
+
+    pip install "streamlit==1.65.*"
+    python benchmarks/bench_fragments.py
+
+CPU saved per rerun on streamlit 1.65.0 varies by about 15 points from
+run to run: roughly half for symptom collection, clinical notes and the
+final report, and nothing measurable for ICD-10 selection, whose full
+rerun already takes only 3-5 ms.
+"""
+
+import os
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from streamlit.testing.v1 import AppTest  # noqa: E402
+
+RUNS = 15
+# Release whose internals rerun_script uses
+STREAMLIT_VERSION = "1.65."
+RERUNS = 20
+
+PATIENT_DATA = {
+    "name": "Thandi Nkosi", "mrn": "MRN100001", "age": 45, "gender": "Female",
+    "visit_type": "New Patient", "severity": 6, "insurance_provider": "Discovery Health",
+    "chief_complaint": "Headache and fever for three days, no cough",
+    "analysis": {"symptoms": ["headache", "fever"], "anatomical_sites": [], "excluded_symptoms": {"cough": "negated"}},
+}
+
+# (section, workflow stage, fragment function)
+SECTIONS = [
+    ("intake: symptom collection", 1, "show_symptom_collection"),
+    ("consultation: clinical notes", 3, "show_clinical_notes"),
+    ("consultation: ICD-10 selection", 3, "show_icd10_selection"),
+    ("final report", 4, "show_report_generator"),
+]
+
+
+def rerun_script(name, scope):
+    """Run the app with one fragment replaced by a copy that reruns itself
+
+    An app-scoped rerun goes through st.rerun(). A fragment-scoped one is
+    requested the way a widget inside the fragment requests it, because
+    st.rerun(scope="fragment") is refused during a full script run.
+    """
+    import streamlit as st
+    import simple_app
+    from streamlit.runtime.scriptrunner import RerunData, get_script_run_ctx
+    from streamlit.runtime.scriptrunner_utils.script_run_context import ThreadState
+
+    original = getattr(simple_app, f"_bench_{name}", None) or getattr(simple_app, name)
+    setattr(simple_app, f"_bench_{name}", original)
+
+    @st.fragment
+    def rerunning_fragment():
+        original.__wrapped__()
+        if st.session_state.bench_reruns > 0:
+            st.session_state.bench_reruns -= 1
+            if scope == "app":
+                st.rerun()
+            ctx = get_script_run_ctx()
+            ctx.script_requests.request_rerun(RerunData(
+                query_string=ctx.query_string,
+                page_script_hash=ctx.page_script_hash,
+                fragment_id_queue=[ThreadState.get().fragment_id],
+                is_fragment_scoped_rerun=True,
+            ))
+            st.empty()
+
+    setattr(simple_app, name, rerunning_fragment)
+    simple_app.main()
+
+
+def prepare(at, stage):
+    at.session_state["authenticated"] = True
+    at.session_state["user_role"] = "doctor"
+    at.session_state["username"] = "doctor"
+    at.session_state["current_stage"] = stage
+    at.session_state["patient_data"] = dict(PATIENT_DATA)
+    at.session_state["uploaded_documents"] = {
+        card: {"filename": f"{card}.jpg", "size": "120.00 KB", "type": "image/jpeg", "upload_time": "2025-01-01 09:00:00"}
+        for card in ("id_card", "medical_aid")
+    }
+    at.session_state["consultation_data"] = {"clinical_notes": "", "selected_icd10": "", "ai_suggestions": []}
+    at.session_state["ai_generated_report"] = None
+    return at
+
+
+def time_run(at, reruns):
+    """Wall and CPU milliseconds for one run that triggers `reruns` reruns"""
+    at.session_state["bench_reruns"] = reruns
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    at.run()
+    wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+    if at.exception:
+        raise RuntimeError(at.exception[0].value)
+    return wall * 1000, cpu * 1000
+
+
+def time_rerun(fragment, stage, scope):
+    """Median wall and CPU milliseconds per rerun, after one warm-up run"""
+    at = prepare(AppTest.from_function(rerun_script, args=(fragment, scope), default_timeout=120), stage)
+    time_run(at, 0)
+    wall, cpu = [], []
+    for _ in range(RUNS):
+        base = time_run(at, 0)
+        rerun = time_run(at, RERUNS)
+        wall.append((rerun[0] - base[0]) / RERUNS)
+        cpu.append((rerun[1] - base[1]) / RERUNS)
+    return statistics.median(wall), statistics.median(cpu)
+
+
+def main():
+    import streamlit
+
+    if not streamlit.__version__.startswith(STREAMLIT_VERSION):
+        sys.exit(f"bench_fragments.py needs streamlit {STREAMLIT_VERSION}x (found {streamlit.__version__})")
+    print(f"{'section':32} {'full rerun':>18} {'fragment rerun':>18} {'CPU saved':>10}")
+    print(f"{'':32} {'wall / CPU ms':>18} {'wall / CPU ms':>18}")
+    for section, stage, fragment in SECTIONS:
+        full = time_rerun(fragment, stage, "app")
+        partial = time_rerun(fragment, stage, "fragment")
+        saved = 1 - partial[1] / full[1]
+        print(f"{section:32} {full[0]:>8.1f} / {full[1]:>6.1f} {partial[0]:>8.1f} / {partial[1]:>6.1f} {saved:>9.0%}")
+
+
+if __name__ == "__main__":
+    main()
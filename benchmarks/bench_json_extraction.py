@@ -0,0 +1,88 @@
+"""
+Micro-benchmark: clean_json_response on pathological ~100 KB model outputs
+
+Compares the single-pass extractor in simple_app.py with the previous
+regex-based implementation (reproduced below). Run from the repo root:
+
+    python benchmarks/bench_json_extraction.py
+"""
+
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from simple_app import clean_json_response  # noqa: E402
+
+TARGET_SIZE = 100 * 1024
+
+
+def legacy_clean_json_response(text):
+    """Previous implementation: two re.findall passes, longest match wins"""
+    json_patterns = [
+        r'\{[^{}]*\}',
+        r'\{(?:[^{}]|(?:\{[^{}]*\}))*\}',
+    ]
+    for pattern in json_patterns:
+        matches = re.findall(pattern, text, re.DOTALL)
+        if matches:
+            json_str = max(matches, key=len)
+            try:
+                json_str = json_str.replace('\n', ' ')
+                json_str = re.sub(r',\s*}', '}', json_str)
+                json_str = re.sub(r',\s*]', ']', json_str)
+                return json.loads(json_str)
+            except json.JSONDecodeError:
+                continue
+    return None
+
+
+CARD = {"name": "Thandi Nkosi", "id_number": "800101 5009 08", "dob": "1980-01-01",
+        "gender": "Female", "nationality": "South African"}
+
+
+def build_inputs():
+    """Return {name: (text, expected_result)}; Ellipsis skips the check"""
+    card = json.dumps(CARD)[:-1] + ",}"
+    chatter = "Sure! Here is what I could read from the card. "
+    nested = {"card": CARD, "meta": {"source": {"page": 1, "note": "braces {} in a string"}}}
+    huge = {f"f{i}": [i, i + 1] for i in range(TARGET_SIZE // 20)}
+    return {
+        "chatty prose + JSON at end": (chatter * (TARGET_SIZE // len(chatter)) + "```json\n" + card + "\n```", CARD),
+        "stray { in prose + JSON": ("Fields are shown as {field: value. " + chatter * (TARGET_SIZE // len(chatter)) + card, CARD),
+        "unclosed braces": ("{ " * (TARGET_SIZE // 2), None),
+        "unclosed object run": ('{"k": 1, ' * (TARGET_SIZE // 9), None),
+        "comma and brace in a string": ('{"s": "a,}", "t": [1, 2,],} trailing ' + chatter * (TARGET_SIZE // len(chatter)), {"s": "a,}", "t": [1, 2]}),
+        "deep nesting": ("{" * (TARGET_SIZE // 2) + "}" * (TARGET_SIZE // 2), ...),
+        "many small objects": (('{"k": 1} ' * (TARGET_SIZE // 9)) + card, CARD),
+        "huge object, trailing commas": ("{" + ", ".join(f'"f{i}": [{i}, {i + 1},]' for i in range(TARGET_SIZE // 20)) + ",}", huge),
+        "3-level nesting in chatter": (chatter * (TARGET_SIZE // len(chatter)) + json.dumps(nested), nested),
+    }
+
+
+def time_call(fn, text, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    print(f"{'input':30} {'size':>7} {'single-pass':>14} {'legacy regex':>14}")
+    for name, (text, expected) in build_inputs().items():
+        new = time_call(clean_json_response, text)
+        old = time_call(legacy_clean_json_response, text, repeat=1)
+        new_ok = old_ok = "-"
+        if expected is not ...:
+            new_ok = "ok" if clean_json_response(text) == expected else "WRONG"
+            old_ok = "ok" if legacy_clean_json_response(text) == expected else "WRONG"
+        print(f"{name:30} {len(text) // 1024:>5}KB {new * 1000:>8.2f}ms {new_ok:>5} {old * 1000:>8.2f}ms {old_ok:>5}")
+
+
+if __name__ == "__main__":
+    main()
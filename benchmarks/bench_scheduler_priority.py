@@ -0,0 +1,77 @@
+"""
+Check: a card extraction submitted after a full report starts within the
+scheduler's own priority latency
+
+Report sections run on their own pool (REPORT_SECTION_WORKERS) and wait for
+quota inside GeminiScheduler.acquire. A card extraction submitted after
+REPORTS full reports must not also sit in a thread pool queue behind them:
+its start delay should be its scheduler wait plus a little overhead. The
+request budget is emptied first so every call has to queue for quota.
+Exits non-zero if the check fails. Run from the repo root:
+
+    python benchmarks/bench_scheduler_priority.py
+"""
+
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import simple_app  # noqa: E402
+from google.genai import types  # noqa: E402,F401  (imported up front, not inside the timed calls)
+
+REPORTS = 2
+CALL_SECONDS = 0.05
+OVERHEAD_SECONDS = 0.1
+
+
+class FakeModels:
+    """Records when each call reaches the API instead of calling Gemini"""
+
+    def __init__(self):
+        self.started = {}
+
+    def generate_content(self, model, contents, config):
+        self.started.setdefault(contents[0], time.monotonic())
+        time.sleep(CALL_SECONDS)
+        return SimpleNamespace(text="ok", usage_metadata=None)
+
+
+def main():
+    client = SimpleNamespace(models=FakeModels())
+    scheduler = simple_app.get_gemini_scheduler()
+    with scheduler._condition:
+        scheduler.requests.level = 0
+
+    sections = [
+        simple_app.submit_report_task(simple_app.gemini_generate, client, "report_section", [f"section {i}"])
+        for i in range(REPORTS * len(simple_app.REPORT_SECTIONS))
+    ]
+    time.sleep(0.2)  # let the report workers reach the scheduler
+
+    submitted = time.monotonic()
+    card = simple_app.submit_ai_task(simple_app.gemini_generate, client, "card_extraction", ["card"])
+    card.result()
+    start_delay = client.models.started["card"] - submitted
+    scheduler_wait = simple_app.get_metrics().snapshot()[1]["gemini_queue_wait_seconds[card_extraction]"]["mean"]
+
+    # Refill the budget so the queued sections finish quickly
+    with scheduler._condition:
+        scheduler.requests.level = scheduler.requests.capacity
+        scheduler._condition.notify_all()
+    for future in sections:
+        future.result()
+
+    print(f"{len(sections)} report sections queued ahead on {simple_app.REPORT_SECTION_WORKERS} report workers")
+    print(f"card extraction: started after {start_delay:.2f} s, scheduler wait {scheduler_wait:.2f} s")
+    if start_delay > scheduler_wait + OVERHEAD_SECONDS:
+        print("FAIL: card extraction queued behind report sections outside the scheduler")
+        sys.exit(1)
+    print("ok")
+
+
+if __name__ == "__main__":
+    main()
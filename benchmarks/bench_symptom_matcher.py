@@ -0,0 +1,70 @@
+"""
+Micro-benchmark: symptom matching cost as the vocabulary grows
+
+Compares the token-trie TermMatcher in simple_app.py with the previous
+per-term substring loop on the same clinical note, for vocabularies of
+increasing size. Run from the repo root:
+
+    python benchmarks/bench_symptom_matcher.py
+"""
+
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from simple_app import SYMPTOM_VOCABULARY, TermMatcher  # noqa: E402
+
+NOTE = (
+    "45 year old presents with headache and fever for three days, productive "
+    "cough, feeling sick and tired. Reports chest pain on exertion and is short "
+    "of breath climbing stairs. Lower back ache since a fall last month, left "
+    "arm and leg normal. Collected medication from the pharmacy yesterday. "
+) * 8
+
+VOCABULARY_SIZES = [10, 1_000, 10_000, 50_000]
+
+
+def synthetic_vocabulary(size, seed=0):
+    """Built-in vocabulary padded with random one to three word terms"""
+    rng = random.Random(seed)
+    symptoms = dict(SYMPTOM_VOCABULARY["symptoms"])
+    while len(symptoms) < size:
+        words = ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 10))) for _ in range(rng.randint(1, 3))]
+        symptoms[" ".join(words)] = []
+    return {"symptoms": symptoms, "anatomical_sites": SYMPTOM_VOCABULARY["anatomical_sites"]}
+
+
+def legacy_match(vocabulary, text):
+    """Previous implementation: one substring test per term"""
+    text_lower = text.lower()
+    return {category: [term for term in terms if term in text_lower] for category, terms in vocabulary.items()}
+
+
+def time_call(fn, repeat=20):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    print(f"note: {len(NOTE)} chars")
+    print(f"{'vocabulary':>10} {'build':>10} {'trie match':>12} {'substring loop':>16}")
+    for size in VOCABULARY_SIZES:
+        vocabulary = synthetic_vocabulary(size)
+        start = time.perf_counter()
+        matcher = TermMatcher(vocabulary)
+        build = time.perf_counter() - start
+        trie = time_call(lambda: matcher.find(NOTE))
+        legacy = time_call(lambda: legacy_match(vocabulary, NOTE))
+        print(f"{size:>10} {build * 1000:>8.1f}ms {trie * 1000:>10.3f}ms {legacy * 1000:>14.3f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+Regression check: negation / history / family context of detected symptoms
+
+Each sentence lists the symptoms simple_medical_analysis must count and the
+ones it must exclude (with their context). A trigger with its own object
+("not feeling well", "no appetite", "history of asthma") must not reach
+over a comma or conjunction onto the next symptom, while a list of matched
+terms ("no fever, cough or chills") stays in scope. Exits non-zero on any
+mismatch. Run from the repo root:
+
+    python benchmarks/check_symptom_context.py
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from simple_app import simple_medical_analysis  # noqa: E402
+
+# (text, counted symptoms, excluded symptoms -> context)
+CASES = [
+    ("Not feeling well, fever and cough since yesterday", ["fever", "cough"], {}),
+    ("No appetite, fever and cough for 2 days", ["fever", "cough"], {}),
+    ("No improvement, fever persists", ["fever"], {}),
+    ("Cough, not productive, fever", ["cough", "fever"], {}),
+    ("negative for fever, cough present", ["cough"], {"fever": "negated"}),
+    ("history of asthma, now cough and fever", ["cough", "fever"], {}),
+    ("No fever, cough or headache", [], {"fever": "negated", "cough": "negated", "headache": "negated"}),
+    ("Denies chest pain, shortness of breath", [], {"pain": "negated", "shortness of breath": "negated"}),
+    ("Headache. No fever.", ["headache"], {"fever": "negated"}),
+    ("had a cough since Monday", ["cough"], {}),
+    ("Sister reports fever", ["fever"], {}),
+    ("previous cough, now fever", ["fever"], {"cough": "historical"}),
+    ("family history of headache, currently cough", ["cough"], {"headache": "family"}),
+]
+
+
+def main():
+    failures = 0
+    for text, symptoms, excluded in CASES:
+        analysis = simple_medical_analysis(text)
+        ok = sorted(analysis["symptoms"]) == sorted(symptoms) and analysis["excluded_symptoms"] == excluded
+        failures += not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {text!r}: {analysis['symptoms']} {analysis['excluded_symptoms']}")
+    if failures:
+        print(f"{failures} of {len(CASES)} cases failed")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Check: report sections settle their token reservation from usage_metadata
+
+Each Gemini call reserves an estimated token cost in the shared TPM budget
+(GeminiScheduler) before it is sent. Report sections are generated by
+separate non-streaming calls on the report pool, so once a section returns
+the budget must reflect the tokens Gemini actually reported: a section that
+used more than estimated is debited the difference, one that used less is
+refunded it, and a response without usage_metadata keeps the estimate.
+Exits non-zero if the check fails. Run from the repo root:
+
+    python benchmarks/check_token_settlement.py
+"""
+
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import simple_app  # noqa: E402
+
+CLINICAL_DATA = {
+    "patient_demographics": {"age": 42, "gender": "Female", "visit_type": "New patient"},
+    "clinical_presentation": {"chief_complaint": "Fever and cough for two days"},
+}
+
+
+class FakeModels:
+    """Returns a fixed section text with the given total token count"""
+
+    def __init__(self, total_token_count):
+        self.usage = None if total_token_count is None else SimpleNamespace(total_token_count=total_token_count)
+
+    def generate_content(self, model, contents, config):
+        return SimpleNamespace(text="Section text.", usage_metadata=self.usage)
+
+
+def section_cost(reported_tokens):
+    """Tokens taken from the TPM budget by one report section, and its estimate"""
+    section = simple_app.REPORT_SECTIONS[0]
+    estimate = simple_app.estimate_gemini_tokens(
+        "report_section", [simple_app.build_report_section_prompt(section, CLINICAL_DATA)])
+    client = SimpleNamespace(models=FakeModels(reported_tokens))
+    scheduler = simple_app.get_gemini_scheduler()
+    with scheduler._condition:
+        scheduler.tokens.level = before = scheduler.tokens.capacity / 2
+        scheduler.tokens._updated = start = time.monotonic()
+    simple_app.submit_report_task(simple_app.generate_report_section, client, section, CLINICAL_DATA).result()
+    with scheduler._condition:
+        refilled = (time.monotonic() - start) * scheduler.tokens.rate
+        return before + refilled - scheduler.tokens.level, estimate, refilled
+
+
+def main():
+    failures = 0
+    estimate = section_cost(None)[1]
+    for label, reported in (("over estimate", estimate + 5000), ("under estimate", estimate // 2), ("no usage_metadata", None)):
+        cost, estimate, refilled = section_cost(reported)
+        expected = estimate if reported is None else reported
+        # The refill is computed after the call returns, so allow for it twice over
+        ok = abs(cost - expected) <= 2 * refilled + 1
+        failures += not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {label}: estimated {estimate}, reported {reported}, budget debited {cost:.0f}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()